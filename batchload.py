@@ -0,0 +1,168 @@
+""" batchload.py | multi-row inserts for the migration scripts
+
+Committing one ORM object at a time costs a round-trip and an fsync per row.
+These helpers write a whole buffer of rows with a single executemany (which
+MySQLdb rewrites into one multi-row INSERT) and hand back the generated
+primary keys so the old->new id mappings can still be built -- or, for a rerun,
+write the rows a previous run already wrote onto themselves instead of again.
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import DBAPIError
+
+
+def primary_key(table):
+	""" the (single) primary key column of table """
+	return list(table.primary_key.columns)[0]
+
+
+@contextmanager
+def transaction(engine):
+	""" a connection to engine with a transaction open on it, committed at the end of
+	the block (or rolled back if the block raises)
+	"""
+	conn = engine.connect()
+	trans = conn.begin()
+	try:
+		yield conn
+		trans.commit()
+	except:
+		trans.rollback()
+		raise
+	finally:
+		conn.close()
+
+
+def sqlite_savepoints(engine):
+	""" make SAVEPOINT work on a SQLite engine. pysqlite begins and commits
+	transactions behind SQLAlchemy's back, which loses savepoints; take that away
+	from it and have SQLAlchemy emit the BEGIN itself (as the SQLAlchemy docs suggest).
+	the BEGIN takes the write lock up front: transactions that read before they write,
+	several at a time, would otherwise deadlock on upgrading their locks and fail with
+	"database is locked" instead of waiting their turn
+	"""
+	if engine.dialect.name != "sqlite":
+		return
+	def connect(dbapi_conn, connection_record):
+		dbapi_conn.isolation_level = None
+	def begin(conn):
+		conn.execute("BEGIN IMMEDIATE")
+	event.listen(engine, "connect", connect)
+	event.listen(engine, "begin", begin)
+
+
+def savepoint(conn, write, rows):
+	""" write(conn, rows) inside a savepoint, rolled back to if it raises """
+	nested = conn.begin_nested()
+	try:
+		result = write(conn, rows)
+		nested.commit()
+	except:
+		nested.rollback()
+		raise
+	return result
+
+
+def write_isolated(conn, rows, write, chunk_size, reject):
+	""" write(conn, chunk) for each chunk_size rows of rows, each chunk inside its own
+	savepoint. write returns a result (e.g. the new id) per row of the chunk.
+
+	a chunk the database refuses is rolled back to its savepoint and written again a
+	row at a time, each in a savepoint of its own, so only the rows that fail by
+	themselves are left out -- handed to reject(row, error) -- and the transaction
+	carries on. returns (the rows written, their results)
+	"""
+	written = []
+	results = []
+	for start in range(0, len(rows), chunk_size):
+		chunk = rows[start:start + chunk_size]
+		try:
+			results.extend(savepoint(conn, write, chunk))
+			written.extend(chunk)
+		except DBAPIError:
+			for row in chunk:
+				try:
+					results.extend(savepoint(conn, write, [row]))
+					written.append(row)
+				except DBAPIError as error:
+					reject(row, error)
+	return written, results
+
+
+def insert_rows(conn, table, rows):
+	""" write rows (a list of dicts) to table as one multi-row insert """
+	if rows:
+		conn.execute(table.insert(), rows)
+
+
+def insert_returning_ids(conn, table, rows, key):
+	""" write rows to table as one multi-row insert and return their new ids, in order
+
+	MySQL hands out consecutive auto-increment values to a single multi-row INSERT
+	(innodb_autoinc_lock_mode 0 or 1) and reports the first one as the insert id.
+	we don't take that on faith: the id range is read back and compared against
+	`key`, a column whose values tell the rows of the batch apart. if someone else's
+	insert got interleaved we bail out rather than build wrong mappings.
+	"""
+	if not rows:
+		return []
+
+	pk = primary_key(table)
+	result = conn.execute(table.insert(), rows)
+	first = result.lastrowid
+	if not first:
+		# some drivers (sqlite3) don't report an insert id for executemany
+		first = conn.execute(select([pk]).order_by(pk.desc()).limit(1)).scalar() - len(rows) + 1
+	ids = range(first, first + len(rows))
+
+	written = conn.execute(select([pk, table.c[key]])
+						   .where(pk.between(ids[0], ids[-1]))
+						   .order_by(pk)).fetchall()
+	if [row[1] for row in written] != [row[key] for row in rows]:
+		raise RuntimeError("%s: generated ids %d-%d don't line up with the batch just written"
+						   % (table.name, ids[0], ids[-1]))
+	return ids
+
+
+def upsert_rows(conn, table, rows, update):
+	""" write rows (a list of dicts, with their primary key) to table as one multi-row
+	statement, updating just the columns in update of the ones already there:
+	INSERT ... ON DUPLICATE KEY UPDATE on MySQL, INSERT ... ON CONFLICT DO UPDATE on SQLite
+	"""
+	if not rows:
+		return
+	columns = sorted(rows[0].keys())
+	placeholder = "?" if conn.dialect.paramstyle == "qmark" else "%s"
+	statement = ("INSERT INTO " + table.name + " (" + ", ".join(columns) + ") VALUES ("
+				 + ", ".join([placeholder] * len(columns)) + ")")
+	if conn.dialect.name == "mysql":
+		statement += " ON DUPLICATE KEY UPDATE " + ", ".join(column + " = VALUES(" + column + ")" for column in update)
+	else:
+		statement += (" ON CONFLICT (" + primary_key(table).name + ") DO UPDATE SET "
+					  + ", ".join(column + " = excluded." + column for column in update))
+	conn.execute(statement, [[row[column] for column in columns] for row in rows])
+
+
+def upsert_returning_ids(conn, table, rows, index, update, insert):
+	""" write rows (a list of dicts) to table and return their ids, in order, without
+	duplicating the ones already there: rows index (a lookups.NaturalKeys) has a row for
+	are written onto that row with upsert_rows(), updating the columns in update (or
+	left as they are, if there are none). the rest go through insert(conn, rows), which
+	returns their new ids
+	"""
+	pk = primary_key(table).name
+	taken = index.take(rows)
+	try:
+		if update:
+			upsert_rows(conn, table, [dict(row, **{pk: id}) for row, id in zip(rows, taken) if id is not None], update)
+		ids = list(taken)
+		fresh = [position for position, id in enumerate(ids) if id is None]
+		for position, id in zip(fresh, insert(conn, [rows[position] for position in fresh])):
+			ids[position] = id
+	except:
+		# rolled back (to a savepoint, and maybe written again a row at a time): the rows can be had again
+		index.give_back(rows, taken)
+		raise
+	return ids
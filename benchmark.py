@@ -0,0 +1,122 @@
+""" benchmark.py | per-phase throughput of hbmigrate.py on synthetic data
+
+Generates an old handbook with gendata.py (local SQLite by default), then runs
+hbmigrate.py against it one phase at a time -- each phase in its own process, so
+its memory high-water mark is its own -- and reports, per phase: wall time, rows
+written to the new handbook, rows/sec, peak RSS, and from hbmigrate.py's metrics
+report the number of SQL statements and commits it took and the time spent
+waiting on the databases.
+
+	python benchmark.py --scale 100000
+	python benchmark.py --scale 100000 --json results.json -- --batch-size 1000
+
+anything after `--` is passed on to hbmigrate.py, so settings can be compared
+against each other on the same data.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from sqlalchemy import create_engine, func, select, MetaData, Table
+
+import gendata
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# hbmigrate.py phases, in order, and the new handbook tables each one writes to
+PHASES = [("cities", ["bf_city", "bf_team", "bf_city_zipcodes"]),
+		  ("users", ["bf_users", "bf_user_meta", "bf_team_members"]),
+		  ("contacts", ["bf_contacts"]),
+		  ("contact_members", ["bf_contact_members"]),
+		  ("bfa_contacts", ["bf_contacts", "bf_contact_members"]),
+		  ("comments", ["bf_contacts_comments"])]
+
+
+def count_rows(url, tables):
+	""" total number of rows in tables """
+	engine = create_engine(url)
+	metadata = MetaData(bind=engine)
+	total = sum(engine.execute(select([func.count()]).select_from(Table(table, metadata, autoload=True))).scalar()
+				for table in tables)
+	engine.dispose()
+	return total
+
+def benchmark_phase(phase, tables, args, migrate_args):
+	""" run one phase in a child process and measure it """
+	metricsfile = os.path.join(args.workdir, phase + ".metrics.json")
+	before = count_rows(args.new_db, tables)
+
+	start = time.time()
+	child = subprocess.Popen([sys.executable, os.path.join(HERE, "hbmigrate.py"), "--phases", phase,
+							  "--metrics", metricsfile] + migrate_args, cwd=args.workdir)
+	pid, status, usage = os.wait4(child.pid, 0)
+	elapsed = time.time() - start
+	if status != 0:
+		raise SystemExit("phase "+phase+" failed, see "+os.path.join(args.workdir, "migrate.log"))
+
+	with open(metricsfile) as f:
+		stats = [measured for measured in json.load(f)["phases"] if measured["phase"] == phase][0]
+	rows = count_rows(args.new_db, tables) - before
+	return dict(phase=phase,
+				seconds=round(elapsed, 3),
+				rows=rows,
+				rows_per_sec=round(rows / elapsed, 1) if elapsed else None,
+				peak_rss_mb=round(usage.ru_maxrss / 1024., 1),
+				statements=sum(engine["statements"] for engine in stats["engines"].itervalues()),
+				commits=stats["commits"],
+				db_seconds=stats["db_seconds"])
+
+
+if __name__ == "__main__":
+	argv = sys.argv[1:]
+	migrate_args = []
+	if "--" in argv:
+		migrate_args = argv[argv.index("--") + 1:]
+		argv = argv[:argv.index("--")]
+
+	parser = argparse.ArgumentParser(description="benchmark hbmigrate.py phase by phase on synthetic data")
+	parser.add_argument("--scale", type=int, default=10000, help="number of old contacts to generate")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--workdir", default="benchmark", help="where the databases, logs and state go")
+	parser.add_argument("--old-db", help="old handbook url, default a SQLite file in --workdir")
+	parser.add_argument("--new-db", help="new handbook url, default a SQLite file in --workdir")
+	parser.add_argument("--no-generate", action="store_true", help="reuse the data of a previous run")
+	parser.add_argument("--json", help="also write the results to this file")
+	args = parser.parse_args(argv)
+
+	args.workdir = os.path.abspath(args.workdir)
+	if not os.path.isdir(args.workdir):
+		os.makedirs(args.workdir)
+	args.old_db = args.old_db or "sqlite:///" + os.path.join(args.workdir, "oldhandbook.db")
+	args.new_db = args.new_db or "sqlite:///" + os.path.join(args.workdir, "newhandbook.db")
+
+	# every run starts from a fresh new handbook, so throw away the previous run's checkpoints
+	statefile = os.path.join(args.workdir, "migrate.state")
+	for path in [statefile, statefile + "-wal", statefile + "-shm"]:
+		if os.path.exists(path):
+			os.remove(path)
+
+	if not args.no_generate:
+		start = time.time()
+		sizes = gendata.generate(args.old_db, args.new_db, args.scale, args.seed)
+		print "generated %d old handbook rows in %.1fs" % (sum(sizes.values()), time.time() - start)
+	else:
+		# keep the old handbook, but the previous run's migrated rows have to go
+		gendata.generate(None, args.new_db, args.scale, args.seed)
+
+	migrate_args = ["--old-db", args.old_db, "--new-db", args.new_db, "--state", statefile] + migrate_args
+
+	results = []
+	print "%-16s %9s %9s %9s %10s %9s %11s %8s" % ("phase", "seconds", "db secs", "rows", "rows/sec", "RSS (MB)", "statements", "commits")
+	for phase, tables in PHASES:
+		result = benchmark_phase(phase, tables, args, migrate_args)
+		results.append(result)
+		print "%(phase)-16s %(seconds)9.2f %(db_seconds)9.2f %(rows)9d %(rows_per_sec)10.1f %(peak_rss_mb)9.1f %(statements)11d %(commits)8d" % result
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"scale": args.scale, "migrate_args": migrate_args, "phases": results}, f, indent=2)
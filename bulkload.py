@@ -0,0 +1,181 @@
+""" bulkload.py | the biggest tables written through files and MySQL's bulk loader
+
+Even as multi-row INSERTs, bf_contacts, bf_contacts_comments, bf_user_meta and
+bf_contact_members take most of a migration's time. MySQL's LOAD DATA LOCAL
+INFILE is several times faster at filling a table, but doesn't tell us the ids
+it generated -- so for the rows we need mappings for, the ids are handed out
+beforehand instead: a range is reserved past the table's current highest id (and its
+auto-increment counter moved beyond it, over a connection of its own) and then
+written into the file with the rows. Moving the counter is an ALTER TABLE, which
+waits for every transaction using the table -- and holds up every one after it while
+it does -- so an IdBlock reserves a whole phase's (or partition's) worth of ids at
+once, sized from its source rows, and hands them out to its batches from memory.
+
+LOAD DATA LOCAL can't stop halfway, so it behaves as if IGNORE was given: rows that
+clash with a unique key are dropped and values that don't fit are cut down, each
+with just a warning. A load with any warnings (or fewer rows than the file) is
+failed instead, so the rows go through the same savepoint and rejects handling as
+those of an INSERT.
+
+Rows go to a temporary TSV file in LOAD DATA's default format (tab separated,
+backslash escapes, \N for NULL). On SQLite, which has no bulk loader, the same
+file is read back and inserted with executemany, so the whole path can be
+exercised locally.
+"""
+
+import os
+import tempfile
+import threading
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import DBAPIError
+
+from batchload import primary_key
+
+# table name -> the id after the last one handed out by reserve_ids(), so that writers
+# running side by side never get the same range (the rows of one needn't be in yet)
+reserved = {}
+reserving = threading.Lock()
+
+# seconds the ALTER TABLE moving an auto-increment counter waits for the transactions
+# using the table (live traffic, or another of our writers) before failing, rather than
+# MySQL's default of a year
+LOCK_WAIT = 60
+
+ESCAPES = [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r"), ("\0", "\\0")]
+
+
+def encode(value):
+	""" value as a field of a LOAD DATA file """
+	if value is None:
+		return "\\N"
+	if isinstance(value, unicode):
+		value = value.encode("utf-8")
+	elif isinstance(value, bool):
+		value = str(int(value))
+	else:
+		value = str(value)
+	for char, escaped in ESCAPES:
+		value = value.replace(char, escaped)
+	return value
+
+def decode(field):
+	""" the value of a LOAD DATA file field, as a string (or None) """
+	if field == "\\N":
+		return None
+	if "\\" not in field:
+		return field.decode("utf-8")
+	unescape = dict((escaped[1], char) for char, escaped in ESCAPES)
+	chars = iter(field)
+	value = []
+	for char in chars:
+		if char == "\\":
+			char = next(chars)
+			char = unescape.get(char, char)
+		value.append(char)
+	return "".join(value).decode("utf-8")
+
+
+class LoadError(DBAPIError):
+	""" LOAD DATA took the file, but not as it was: rows were dropped or values changed """
+
+
+def reserve_ids(engine, table, n):
+	""" the first of n consecutive ids of table nobody else will be given. call it
+	before the transaction the rows are loaded in begins: it works over a connection
+	of its own, which on MySQL moves the table's auto-increment counter past them
+	(a DDL statement, which would wait for any transaction that has used the table --
+	reserve as many at once as there will be rows, see IdBlock)
+	"""
+	pk = primary_key(table)
+	with reserving:
+		conn = engine.connect()
+		try:
+			if engine.dialect.name == "mysql":
+				conn.execute("SET SESSION lock_wait_timeout = %d" % LOCK_WAIT)
+			while True:
+				first = max((conn.execute(select([func.max(pk)])).scalar() or 0) + 1, reserved.get(table.name, 0))
+				if engine.dialect.name == "mysql":
+					conn.execute("ALTER TABLE %s AUTO_INCREMENT = %d" % (table.name, first + n))
+				# an insert that got in before the counter moved may have taken some of them
+				if not conn.execute(select([func.count()], pk.between(first, first + n - 1))).scalar():
+					break
+			reserved[table.name] = first + n
+		finally:
+			conn.close()
+	return first
+
+class IdBlock(object):
+	""" ids of table for the rows a phase (or a range of one) is about to bulk load,
+	reserved with reserve_ids() size at a time -- in practice once, size being its
+	source rows still to be migrated -- and handed out as its batches need them.
+	safe to share between threads
+	"""
+
+	def __init__(self, engine, table, size):
+		self.engine = engine
+		self.table = table
+		self.size = max(size, 1)
+		self.next = self.end = 0 # (nothing reserved until the first take())
+		self.lock = threading.Lock()
+
+	def take(self, n):
+		""" the first of n consecutive ids out of the block, reserving another if it ran
+		out (more rows than were counted: some came in since)
+		"""
+		with self.lock:
+			if self.next + n > self.end:
+				size = max(n, self.size)
+				self.next = reserve_ids(self.engine, self.table, size)
+				self.end = self.next + size
+			first = self.next
+			self.next += n
+			return first
+
+def bulk_insert(conn, table, rows, directory=None):
+	""" load rows (a list of dicts, all with the same keys) into table through a file """
+	if not rows:
+		return
+	columns = sorted(rows[0].keys())
+	f = tempfile.NamedTemporaryFile(dir=directory, prefix=table.name + ".", suffix=".tsv", delete=False)
+	try:
+		with f:
+			for row in rows:
+				f.write("\t".join(encode(row[column]) for column in columns) + "\n")
+		load_file(conn, table, columns, f.name, len(rows))
+	finally:
+		os.remove(f.name)
+
+def bulk_insert_returning_ids(conn, table, rows, directory=None):
+	""" bulk_insert() rows that carry the ids reserve_ids() gave them, returns the ids in order """
+	if not rows:
+		return []
+	pk = primary_key(table).name
+	if any(row.get(pk) is None for row in rows):
+		raise ValueError(table.name+": rows bulk loaded for their ids need them reserved up front")
+	bulk_insert(conn, table, rows, directory)
+	return [row[pk] for row in rows]
+
+def load_file(conn, table, columns, path, count):
+	""" load the TSV file of count rows at path into columns of table, LoadError if they
+	don't all go in as they are
+	"""
+	if conn.engine.dialect.name == "mysql":
+		# (the connection needs to have been made with local_infile=1)
+		statement = ("LOAD DATA LOCAL INFILE %s INTO TABLE " + table.name + " CHARACTER SET utf8 "
+					 "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+					 "(" + ", ".join(columns) + ")")
+		loaded = conn.execute(statement, (path,)).rowcount
+		# (level, code, message), leaving out the notes
+		warnings = [tuple(warning) for warning in conn.execute("SHOW WARNINGS") if warning[0] != "Note"]
+		if loaded != count or warnings:
+			raise LoadError(statement, (path,),
+							RuntimeError("%d of %d rows loaded into %s, %d warnings: %s" % (loaded, count, table.name,
+								len(warnings), "; ".join("%s %s: %s" % warning for warning in warnings[:5]))))
+		return
+
+	# no bulk loader: read the file back and insert what's in it, as strings like LOAD DATA would
+	with open(path) as f:
+		rows = [[decode(field) for field in line.rstrip("\n").split("\t")] for line in f]
+	conn.execute("INSERT INTO " + table.name + " (" + ", ".join(columns) + ") VALUES ("
+				 + ", ".join("?" * len(columns)) + ")", rows)
@@ -0,0 +1,382 @@
+""" gendata.py | a synthetic old handbook to migrate from
+
+There's no way to measure migration throughput without something the size of
+production to migrate. This builds a stand-in: the old handbook tables the
+migration scripts read (cities, users, contacts, contacts_users, bfa_contacts,
+bfa_contacts_users, comments), filled with made-up rows at whatever scale you ask
+for, plus the new handbook's bf_* tables with the zipcodes and merge-target
+cities/teams the migration expects to find there.
+
+	python gendata.py --scale 100000 --old-db sqlite:///old.db --new-db sqlite:///new.db
+
+--scale is the number of old contacts, the other tables are sized relative to it
+(see RATIOS). Any SQLAlchemy url works, e.g. a scratch database on a local MySQL.
+The data is random but deterministic for a given --seed and --now (the day its
+dates are counted back from), and includes the messy
+bits the migration has to cope with: contacts older than a year, links to users
+and bfa contacts that no longer exist, comments on contacts that won't be imported.
+"""
+
+import argparse
+import datetime
+import random
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Text, Date, DateTime
+
+# rows per old contact
+RATIOS = {
+	"cities": 1 / 2000.,
+	"users": 1 / 20.,
+	"contacts": 1,
+	"contacts_users": 1,
+	"bfa_contacts": 1 / 4.,
+	"bfa_contacts_users": 1 / 4.,
+	"comments": 2,
+}
+
+ZIPCODES_PER_CITY = 3
+
+STATES = ["AL", "CA", "FL", "GA", "IL", "NY", "OH", "TN", "TX", "WA"]
+FIRST_NAMES = ["james", "mary", "john", "patricia", "robert", "jennifer", "michael", "linda",
+			   "david", "elizabeth", "daniel", "sarah", "joseph", "grace", "paul", "ruth"]
+LAST_NAMES = ["smith", "johnson", "williams", "brown", "jones", "garcia", "miller", "davis",
+			  "lee", "kim", "park", "nguyen", "chen", "lopez", "clark", "young"]
+WORDS = ["met", "at", "the", "park", "wants", "to", "study", "called", "back", "next",
+		 "week", "visited", "family", "prayed", "with", "gave", "book", "follow", "up"]
+
+
+""" schema: only the columns the migration scripts touch """
+
+def old_tables(metadata):
+	""" oldhandbook """
+	Table("cities", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("name", String(255)),
+		  Column("state", String(2)),
+		  Column("migrate", String(1)))
+	Table("users", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("city_id", Integer),
+		  Column("email", String(255)),
+		  Column("first_name", String(255)),
+		  Column("last_name", String(255)),
+		  Column("gender", String(1)),
+		  Column("age", Integer),
+		  Column("cellphone", String(32)),
+		  Column("homephone", String(32)),
+		  Column("dob", Date),
+		  Column("locality", String(255)),
+		  Column("socialcast_url", String(255)),
+		  Column("socialcast_group", Integer),
+		  Column("bfa_access", Integer),
+		  Column("admin_role", Integer),
+		  Column("teamcoordinator_role", Integer),
+		  Column("teammember_role", Integer),
+		  Column("last_sign_in_ip", String(64)),
+		  Column("created_at", DateTime),
+		  Column("updated_at", DateTime, index=True))
+	Table("contacts", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("city_id", Integer, index=True),
+		  Column("first_name", String(255)),
+		  Column("last_name", String(255)),
+		  Column("email", String(255)),
+		  Column("phone", String(32)),
+		  Column("gender", String(1)),
+		  Column("address", String(255)),
+		  Column("addr_city", String(255)),
+		  Column("state", String(2)),
+		  Column("zip", String(10)),
+		  Column("datemet", Date, index=True),
+		  Column("created_at", DateTime),
+		  Column("updated_at", DateTime, index=True))
+	Table("contacts_users", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("contact_id", Integer),
+		  Column("user_id", Integer))
+	Table("bfa_recipients", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("name", String(255)))
+	Table("bfa_contacts", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("first_name", String(255)),
+		  Column("last_name", String(255)),
+		  Column("email", String(255)),
+		  Column("phone", String(32)),
+		  Column("address", String(255)),
+		  Column("addr_city", String(255)),
+		  Column("state", String(2)),
+		  Column("zip", String(10)),
+		  Column("date", Date, index=True),
+		  Column("bfa_wantbiblestudy", Integer),
+		  Column("bfa_orderitems", String(255)),
+		  Column("bfa_dateordered", DateTime),
+		  Column("bfa_customerid", String(32)),
+		  Column("created_at", DateTime),
+		  Column("updated_at", DateTime, index=True))
+	Table("bfa_contacts_users", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("bfa_contact_id", Integer),
+		  Column("user_id", Integer))
+	Table("comments", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("commentable_id", Integer, index=True),
+		  Column("commentable_type", String(32)),
+		  Column("user_id", Integer),
+		  Column("content", Text),
+		  Column("created_at", DateTime),
+		  Column("updated_at", DateTime, index=True))
+	return metadata
+
+def new_tables(metadata):
+	""" newhandbook """
+	Table("bf_city", metadata,
+		  Column("city_id", Integer, primary_key=True),
+		  Column("city_name", String(255), index=True),
+		  Column("city_state", String(2)),
+		  Column("city_description", Text))
+	Table("bf_zipcode", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("zip_code", String(10), index=True),
+		  Column("city", String(255), index=True),
+		  Column("state", String(2)))
+	Table("bf_city_zipcodes", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("city_id", Integer),
+		  Column("city_group_id", Integer),
+		  Column("zipcode_id", Integer),
+		  Column("zipcode", String(10)),
+		  Column("type", Integer))
+	Table("bf_team", metadata,
+		  Column("team_id", Integer, primary_key=True),
+		  Column("team_name", String(255)),
+		  Column("team_assigned_city", Integer, index=True))
+	Table("bf_users", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("email", String(255)),
+		  Column("username", String(255)),
+		  Column("display_name", String(255)),
+		  Column("password_hash", String(255)),
+		  Column("salt", String(255)),
+		  Column("last_ip", String(64)),
+		  Column("active", Integer),
+		  Column("activate_hash", String(255)),
+		  Column("role_id", Integer),
+		  Column("created_on", DateTime))
+	Table("bf_user_meta", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("user_id", Integer),
+		  Column("meta_key", String(255)),
+		  Column("meta_value", Text))
+	Table("bf_team_members", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("user_id", Integer),
+		  Column("team_id", Integer),
+		  Column("role", Integer),
+		  Column("label", String(255)),
+		  Column("active", Integer),
+		  Column("active_team", Integer),
+		  Column("bfa_approved", Integer))
+	Table("bf_oms_contacts", metadata,
+		  Column("id", Integer, primary_key=True))
+	Table("bf_contacts", metadata,
+		  Column("contact_id", Integer, primary_key=True),
+		  Column("team_id", Integer),
+		  Column("contacts_firstname", String(255)),
+		  Column("contacts_lastname", String(255)),
+		  Column("contacts_email", String(255)),
+		  Column("contacts_phone", String(32)),
+		  Column("contacts_gender", String(1)),
+		  Column("contacts_address", String(255)),
+		  Column("contacts_city", String(255)),
+		  Column("contacts_state", String(2)),
+		  Column("contacts_zip", String(10)),
+		  Column("date_met", Date),
+		  Column("customer_id", String(32)),
+		  Column("biblestudy_interest", Integer),
+		  Column("contacts_books", String(255)),
+		  Column("oms_date_ordered", Date))
+	Table("bf_contact_members", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("contact_id", Integer),
+		  Column("member_id", Integer))
+	Table("bf_contacts_comments", metadata,
+		  Column("id", Integer, primary_key=True),
+		  Column("contact_id", Integer),
+		  Column("member_id", Integer),
+		  Column("contact_comment", Text),
+		  Column("date_added", DateTime))
+	return metadata
+
+
+""" rows """
+
+def sizes(scale):
+	""" number of rows per old table for a given scale """
+	return dict((table, max(5, int(scale * ratio))) for table, ratio in RATIOS.iteritems())
+
+class Generator(object):
+	""" deterministic random rows for the old and new handbook tables """
+
+	def __init__(self, scale, seed=0, now=None):
+		self.n = sizes(scale)
+		self.seed = seed
+		self.random = random.Random(seed)
+		# midnight, like the migration's one-year cutoff, so the same rows fall either side of it whatever the time of day
+		self.now = datetime.datetime.combine(now or datetime.date.today(), datetime.time())
+		# fixed up front so old and new handbook agree on them
+		self.cities = [(id, "city%d" % id, self.random.choice(STATES),
+						self.random.choice("yyyyyyyymn")) for id in range(1, self.n["cities"] + 1)]
+
+	def past(self, days):
+		""" a random moment within the last days days """
+		return self.now - datetime.timedelta(seconds=self.random.randint(0, days * 86400))
+
+	def phone(self):
+		return "%03d-%03d-%04d" % (self.random.randint(200, 999), self.random.randint(0, 999),
+								   self.random.randint(0, 9999))
+
+	def text(self, words):
+		return " ".join(self.random.choice(WORDS) for i in range(words))
+
+	def city_id(self):
+		return self.random.randint(1, self.n["cities"])
+
+	def dangling(self, table, rate=0.02):
+		""" an id in table -- or, rate of the time, one that doesn't exist (anymore) """
+		if self.random.random() < rate:
+			return self.n[table] + self.random.randint(1, 1000)
+		return self.random.randint(1, self.n[table])
+
+	def reseed(self, table):
+		""" start table's rows from a random state of their own, so they don't depend on
+		the order the tables get written in (sorted_tables only fixes it up to dependencies)
+		"""
+		self.random = random.Random("%d:%s" % (self.seed, table))
+		return self.random
+
+	def old_rows(self, table):
+		""" the rows of an old handbook table, in id order """
+		r = self.reseed(table)
+		if table == "cities":
+			for id, name, state, migrate in self.cities:
+				yield dict(id=id, name=name, state=state, migrate=migrate)
+		elif table == "users":
+			for id in range(1, self.n[table] + 1):
+				created = self.past(2000)
+				yield dict(id=id, city_id=self.city_id(), email="user%d@example.com" % id,
+						   first_name=r.choice(FIRST_NAMES).title(), last_name=r.choice(LAST_NAMES).title(),
+						   gender=r.choice("mf"), age=r.randint(18, 70), cellphone=self.phone(),
+						   homephone=self.phone(), dob=self.past(20000).date(), locality=None,
+						   socialcast_url=None, socialcast_group=r.randint(0, 1), bfa_access=r.randint(0, 1),
+						   admin_role=int(r.random() < 0.01), teamcoordinator_role=int(r.random() < 0.05),
+						   teammember_role=1, last_sign_in_ip=r.choice([None, "10.0.%d.%d" % (r.randint(0, 255), r.randint(1, 254))]),
+						   created_at=created, updated_at=created)
+		elif table == "contacts":
+			for id in range(1, self.n[table] + 1):
+				created = self.past(730)
+				yield dict(id=id, city_id=self.city_id(), first_name=r.choice(FIRST_NAMES).title(),
+						   last_name=r.choice(LAST_NAMES).title(), email="contact%d@example.com" % id,
+						   phone=self.phone(), gender=r.choice("mf"), address="%d main st" % r.randint(1, 9999),
+						   addr_city="city%d" % self.city_id(), state=r.choice(STATES),
+						   zip="%05d" % r.randint(501, 99950), datemet=created.date(),
+						   created_at=created, updated_at=created)
+		elif table == "contacts_users":
+			for id in range(1, self.n[table] + 1):
+				yield dict(id=id, contact_id=self.random.randint(1, self.n["contacts"]),
+						   user_id=self.dangling("users"))
+		elif table == "bfa_recipients":
+			return
+		elif table == "bfa_contacts":
+			for id in range(1, self.n[table] + 1):
+				created = self.past(730)
+				yield dict(id=id, first_name=r.choice(FIRST_NAMES).title(), last_name=r.choice(LAST_NAMES).title(),
+						   email="bfa%d@example.com" % id, phone=self.phone(),
+						   address="%d oak ave" % r.randint(1, 9999), addr_city="city%d" % self.city_id(),
+						   state=r.choice(STATES), zip="%05d" % r.randint(501, 99950), date=created.date(),
+						   bfa_wantbiblestudy=r.randint(0, 1), bfa_orderitems=self.text(3),
+						   bfa_dateordered=created, bfa_customerid="C%08d" % id,
+						   created_at=created, updated_at=created)
+		elif table == "bfa_contacts_users":
+			for id in range(1, self.n[table] + 1):
+				yield dict(id=id, bfa_contact_id=self.dangling("bfa_contacts"),
+						   user_id=self.random.randint(1, self.n["users"]))
+		elif table == "comments":
+			for id in range(1, self.n[table] + 1):
+				created = self.past(730)
+				if r.random() < 0.3:
+					commentable = ("BfaContact", r.randint(1, self.n["bfa_contacts"]))
+				else:
+					commentable = ("Contact", r.randint(1, self.n["contacts"]))
+				yield dict(id=id, commentable_type=commentable[0], commentable_id=commentable[1],
+						   user_id=self.dangling("users"), content=self.text(r.randint(5, 40)),
+						   created_at=created, updated_at=created)
+
+	def new_rows(self, table):
+		""" what the new handbook already holds before the migration """
+		if table == "bf_city":
+			for id, name, state, migrate in self.cities:
+				if migrate == "m":
+					yield dict(city_id=id, city_name=name, city_state=state, city_description="")
+		elif table == "bf_team":
+			for id, name, state, migrate in self.cities:
+				if migrate == "m":
+					yield dict(team_id=id, team_name=name+", "+state, team_assigned_city=id)
+		elif table == "bf_zipcode":
+			id = 0
+			for city, name, state, migrate in self.cities:
+				for i in range(ZIPCODES_PER_CITY):
+					id += 1
+					yield dict(id=id, zip_code="%05d" % (501 + id), city=name, state=state)
+
+
+def write(engine, table, rows, chunk_size=10000):
+	""" insert rows into table, chunk_size at a time, returns the number written """
+	count = 0
+	chunk = []
+	for row in rows:
+		chunk.append(row)
+		if len(chunk) >= chunk_size:
+			engine.execute(table.insert(), chunk)
+			count += len(chunk)
+			chunk = []
+	if chunk:
+		engine.execute(table.insert(), chunk)
+		count += len(chunk)
+	return count
+
+def generate(old_url, new_url, scale, seed=0, report=None, now=None):
+	""" (re)create and fill the old and new handbook tables, old_url can be None
+	to only reset the new handbook. dates are counted back from the date now (default today)
+	"""
+	generator = Generator(scale, seed, now)
+	for url, metadata, rows in [(old_url, old_tables(MetaData()), generator.old_rows),
+								(new_url, new_tables(MetaData()), generator.new_rows)]:
+		if url is None:
+			continue
+		engine = create_engine(url)
+		metadata.drop_all(engine)
+		metadata.create_all(engine)
+		for table in metadata.sorted_tables:
+			count = write(engine, table, rows(table.name))
+			if report is not None:
+				report(table.name, count)
+		engine.dispose()
+	return generator.n
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="build a synthetic old handbook (and empty new one) to migrate")
+	parser.add_argument("--scale", type=int, default=1000, help="number of old contacts, other tables scale with it")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--now", type=lambda day: datetime.datetime.strptime(day, "%Y-%m-%d").date(),
+						help="date (YYYY-MM-DD) the rows' dates are counted back from, default today. the migration "
+							 "only takes contacts from the year before the day it runs, so keep it close to that")
+	parser.add_argument("--old-db", default="sqlite:///oldhandbook.db")
+	parser.add_argument("--new-db", default="sqlite:///newhandbook.db")
+	args = parser.parse_args()
+
+	def report(table, count):
+		print "%-24s %10d rows" % (table, count)
+
+	generate(args.old_db, args.new_db, args.scale, args.seed, report, args.now)
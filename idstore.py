@@ -0,0 +1,301 @@
+""" idstore.py | durable old->new id mappings and phase checkpoints
+
+The id mappings a migration builds up (city2city, user2member, contact2contact...)
+used to live only in process memory, so a crash halfway through the comments
+meant starting over from zero -- and a rerun duplicates everything already written.
+
+MigrationState keeps them in a local SQLite file instead, next to a per-phase
+checkpoint (the last source row id committed, and whether the phase finished).
+A restarted run loads the mappings back, skips finished phases and picks the
+unfinished one up after its last committed row.
+
+It also keeps a per-table high-watermark (the newest updated_at seen), which is
+what lets an incremental rerun pick out the source rows changed since.
+
+And the usernames and emails given to accounts whose own were taken, so that the
+runs after the one that chose them (a sync, a verify) build the same rows.
+
+The store is committed right after the new handbook db is, so a crash in between
+would leave the rows of the last commit written but not recorded -- and a resumed
+run would write them again. So each batch also leaves a Journal entry in the new
+handbook db, in the same transaction as its rows: its checkpoint and the mappings
+it made. A restarted run replays the entries of its own run into the store before
+loading anything back, which brings it up to the last row the new db committed.
+"""
+
+import cPickle as pickle
+import sqlite3
+import threading
+import uuid
+
+from array import array
+
+from sqlalchemy import Column, Integer, LargeBinary, MetaData, String, Table, and_, select
+
+
+class IdMap(object):
+	""" old id -> new id, recording every new entry in the store.
+
+	old handbook ids are dense auto-increment integers, so rather than a dict (a boxed
+	key, a boxed value and a hash slot per entry -- gigabytes at tens of millions of
+	rows) the new ids are kept in a typed array indexed by old id, with MISSING in the
+	slots of ids that weren't migrated. lookups of those raise KeyError, like a dict.
+	"""
+
+	MISSING = -1 # new ids (and the 0 "no team" of user2team) are never negative
+
+	def __init__(self, state, name):
+		self.state = state
+		self.name = name
+		self.ids = array("l")
+		self.count = 0
+		with state.lock:
+			for old, new in state.conn.execute("SELECT old_id, new_id FROM idmap WHERE name = ?", (name,)):
+				self.put(old, new)
+
+	def slot(self, old):
+		""" index of old in the array, KeyError if it can't have one """
+		if not isinstance(old, (int, long)) or old < 0:
+			raise KeyError(old)
+		return old
+
+	def put(self, old, new):
+		""" set old -> new in memory only """
+		index = self.slot(old)
+		if index >= len(self.ids):
+			# grow geometrically so a run of inserts in id order stays amortized O(1)
+			self.ids.extend(array("l", [self.MISSING]) * (max(index + 1, 2 * len(self.ids)) - len(self.ids)))
+		if self.ids[index] == self.MISSING:
+			self.count += 1
+		self.ids[index] = new
+
+	def __getitem__(self, old):
+		index = self.slot(old)
+		if index >= len(self.ids) or self.ids[index] == self.MISSING:
+			raise KeyError(old)
+		return self.ids[index]
+
+	def __setitem__(self, old, new):
+		self.update([(old, new)])
+
+	def update(self, pairs):
+		""" set each (old id, new id) of pairs, in memory and in the store (to be committed
+		with the next checkpoint). safe to call from several threads at once
+		"""
+		pairs = list(pairs)
+		with self.state.lock:
+			for old, new in pairs:
+				self.put(old, new)
+			self.state.conn.executemany("INSERT OR REPLACE INTO idmap (name, old_id, new_id) VALUES (?, ?, ?)",
+										[(self.name, old, new) for old, new in pairs])
+
+	def __contains__(self, old):
+		try:
+			self[old]
+			return True
+		except KeyError:
+			return False
+
+	def get(self, old, default=None):
+		try:
+			return self[old]
+		except KeyError:
+			return default
+
+	def __len__(self):
+		return self.count
+
+	def highest(self):
+		""" the highest mapped old id, 0 if none """
+		for old in xrange(len(self.ids) - 1, -1, -1):
+			if self.ids[old] != self.MISSING:
+				return old
+		return 0
+
+	def between(self, lo, hi):
+		""" (old id, new id) of the mapped ids in [lo, hi) """
+		for offset, new in enumerate(self.ids[lo:hi]):
+			if new != self.MISSING:
+				yield lo + offset, new
+
+	def iteritems(self):
+		""" (old id, new id) of every mapped id, in old id order """
+		for old, new in enumerate(self.ids):
+			if new != self.MISSING:
+				yield old, new
+
+	def __iter__(self):
+		for old, new in self.iteritems():
+			yield old
+
+
+class MigrationState(object):
+	""" the on-disk record of a migration run: id mappings and phase checkpoints.
+	safe to share between threads (a pipelined phase checkpoints from its writer thread)
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.RLock()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		# survives the migration process dying, which is what we care about,
+		# without paying an fsync on every checkpoint
+		self.conn.execute("PRAGMA journal_mode = WAL")
+		self.conn.execute("PRAGMA synchronous = NORMAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS idmap ("
+						  "name TEXT, old_id INTEGER, new_id INTEGER, PRIMARY KEY (name, old_id))")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS checkpoint ("
+						  "phase TEXT PRIMARY KEY, last_id INTEGER, done INTEGER NOT NULL DEFAULT 0)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS watermark (tablename TEXT PRIMARY KEY, value BLOB)")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS renamed ("
+						  "name TEXT, old_id INTEGER, username TEXT, email TEXT, PRIMARY KEY (name, old_id))")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS run (id TEXT)")
+		row = self.conn.execute("SELECT id FROM run").fetchone()
+		if row is None:
+			# tells our journal entries apart from those of a state file deleted to start over
+			row = (uuid.uuid4().hex,)
+			self.conn.execute("INSERT INTO run (id) VALUES (?)", row)
+		self.run = str(row[0])
+		self.conn.commit()
+
+	def execute(self, sql, parameters=(), commit=False):
+		""" run sql against the store, returns the first row of the result """
+		with self.lock:
+			row = self.conn.execute(sql, parameters).fetchone()
+			if commit:
+				self.conn.commit()
+			return row
+
+	def commit(self):
+		""" commit the mappings set since the last checkpoint, without moving any """
+		with self.lock:
+			self.conn.commit()
+
+	def idmap(self, name):
+		""" the stored mapping called name, loaded back from disk """
+		return IdMap(self, name)
+
+	def position(self, phase):
+		""" id of the last source row committed in phase, or None if it hasn't started """
+		row = self.execute("SELECT last_id FROM checkpoint WHERE phase = ?", (phase,))
+		return row[0] if row is not None else None
+
+	def done(self, phase):
+		""" whether phase ran to completion """
+		row = self.execute("SELECT done FROM checkpoint WHERE phase = ?", (phase,))
+		return row is not None and row[0] == 1
+
+	def checkpoint(self, phase, last_id):
+		""" record that phase has committed everything up to source row last_id,
+		along with any mappings set since the last checkpoint
+		"""
+		self.execute("INSERT OR REPLACE INTO checkpoint (phase, last_id, done) VALUES (?, ?, 0)",
+					 (phase, last_id), commit=True)
+
+	def finish(self, phase):
+		""" mark phase as complete """
+		self.execute("INSERT OR REPLACE INTO checkpoint (phase, last_id, done) "
+					 "VALUES (?, (SELECT last_id FROM checkpoint WHERE phase = ?), 1)", (phase, phase), commit=True)
+
+	def replay(self, journal):
+		""" bring the store up to what the new handbook db committed: the mappings of every
+		entry of journal for this run, and the checkpoints they moved past ours. call it
+		before loading any mapping. returns the number of entries that had something to add
+		"""
+		replayed = 0
+		with self.lock:
+			for phase, slot, last_id, pairs in journal.entries():
+				changes = self.conn.total_changes
+				for name, items in pairs.iteritems():
+					# (the mappings already in the store are the same ones)
+					self.conn.executemany("INSERT OR IGNORE INTO idmap (name, old_id, new_id) VALUES (?, ?, ?)",
+										  [(name, old, new) for old, new in items])
+				position = self.position(phase)
+				if last_id is not None and not self.done(phase) and (position is None or last_id > position):
+					self.conn.execute("INSERT OR REPLACE INTO checkpoint (phase, last_id, done) VALUES (?, ?, 0)",
+									  (phase, last_id))
+				if self.conn.total_changes > changes:
+					replayed += 1
+			self.conn.commit()
+		return replayed
+
+	def watermark(self, table):
+		""" the high-watermark recorded for table (any picklable value), or None """
+		row = self.execute("SELECT value FROM watermark WHERE tablename = ?", (table,))
+		return pickle.loads(str(row[0])) if row is not None else None
+
+	def set_watermark(self, table, value):
+		""" record value as table's new high-watermark """
+		self.execute("INSERT OR REPLACE INTO watermark (tablename, value) VALUES (?, ?)",
+					 (table, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))), commit=True)
+
+	def renamed(self, name):
+		""" old id -> (username, email) given to the accounts of name (users, say) in place of their own """
+		with self.lock:
+			return dict((old, (username, email)) for old, username, email in
+						self.conn.execute("SELECT old_id, username, email FROM renamed WHERE name = ?", (name,)))
+
+	def set_renamed(self, name, renamed, ids):
+		""" record renamed (as returned by renamed()) as the names given to the accounts of
+		name with old ids ids, forgetting what was recorded for the rest of them
+		"""
+		with self.lock:
+			self.conn.executemany("DELETE FROM renamed WHERE name = ? AND old_id = ?", [(name, id) for id in ids])
+			self.conn.executemany("INSERT INTO renamed (name, old_id, username, email) VALUES (?, ?, ?, ?)",
+								  [(name, id, username, email) for id, (username, email) in renamed.iteritems()])
+			self.conn.commit()
+
+
+class Journal(object):
+	""" the last batch each writer of a phase committed to the new handbook db, kept in
+	a table of its own there. record() it in the transaction that writes the batch's
+	rows, and the checkpoint and mappings can't be lost to a crash before the store is
+	committed: MigrationState.replay() picks them back up.
+
+	a phase has one entry per writer (slot): ONE for a phase written in order, the
+	first old id of the range for each range of a partitioned one -- which doesn't move
+	the checkpoint (run_partitioned() does), its entry only brings the mappings back
+	"""
+
+	ONE = -1 # the slot of a phase's single writer (old ids, and so ranges, start at 0 or above)
+
+	def __init__(self, engine, run, tablename="migrate_journal"):
+		self.engine = engine
+		self.run = run
+		self.table = Table(tablename, MetaData(),
+						   Column("run", String(32), primary_key=True),
+						   Column("phase", String(32), primary_key=True),
+						   Column("slot", Integer, primary_key=True, autoincrement=False),
+						   Column("last_id", Integer),
+						   Column("pairs", LargeBinary(2 ** 24)))
+		self.table.create(engine, checkfirst=True)
+
+	def where(self, phase, slot=None):
+		criteria = [self.table.c.run == self.run, self.table.c.phase == phase]
+		if slot is not None:
+			criteria.append(self.table.c.slot == slot)
+		return and_(*criteria)
+
+	def record(self, conn, phase, pairs, last_id=None, slot=ONE):
+		""" note in conn's transaction that phase's writer slot has committed source rows
+		up to last_id (None if it doesn't checkpoint), making pairs: id mapping name ->
+		[(old id, new id)]
+		"""
+		values = dict(last_id=last_id,
+					  pairs=pickle.dumps(dict((name, list(items)) for name, items in pairs.iteritems()),
+										 pickle.HIGHEST_PROTOCOL))
+		if not conn.execute(self.table.update().where(self.where(phase, slot)).values(**values)).rowcount:
+			conn.execute(self.table.insert().values(run=self.run, phase=phase, slot=slot, **values))
+
+	def entries(self):
+		""" (phase, slot, last id, pairs) of every entry of this run """
+		for phase, slot, last_id, pairs in self.engine.execute(
+				select([self.table.c.phase, self.table.c.slot, self.table.c.last_id, self.table.c.pairs],
+					   self.table.c.run == self.run)):
+			yield phase, slot, last_id, pickle.loads(str(pairs))
+
+	def forget(self, phase, slot=None):
+		""" drop the entries of phase (or just that of its writer slot), once the store has
+		committed everything they hold
+		"""
+		self.engine.execute(self.table.delete().where(self.where(phase, slot)))
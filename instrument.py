@@ -0,0 +1,194 @@
+""" instrument.py | per-phase metrics for the migration scripts
+
+The "### migrating ... ###" banners in the logs say what a run is doing, but not
+how long it takes or where the time goes. Metrics hooks into the SQLAlchemy
+engine events of the old and new handbook engines and keeps, for each phase:
+
+	- wall time, and the rows it processed (and so rows/sec)
+	- per engine: statements sent, time spent waiting on the database, and a
+	  histogram of statement round-trip latencies
+	- commits
+	- the time left over once the database waits are taken out, i.e. the time
+	  spent in Python
+
+and writes it all out as a JSON report, every `interval` seconds while the run
+goes on and once more at the end.
+"""
+
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# upper bounds (in ms) of the latency histogram buckets
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class PhaseMetrics(object):
+	""" what happened during one phase """
+
+	def __init__(self):
+		self.started = time.time()
+		self.finished = None
+		self.rows = 0
+		self.commits = 0
+		self.engines = {}
+
+	def engine(self, name):
+		if name not in self.engines:
+			self.engines[name] = {"statements": 0, "seconds": 0.0, "latency_ms": [0] * (len(BUCKETS) + 1)}
+		return self.engines[name]
+
+	def report(self):
+		seconds = (self.finished or time.time()) - self.started
+		dbseconds = sum(engine["seconds"] for engine in self.engines.itervalues())
+		engines = {}
+		for name, engine in self.engines.iteritems():
+			histogram = {}
+			for bound, count in zip(["<=" + str(bound) for bound in BUCKETS] + [">" + str(BUCKETS[-1])],
+									engine["latency_ms"]):
+				if count:
+					histogram[bound] = count
+			engines[name] = {"statements": engine["statements"],
+							 "db_seconds": round(engine["seconds"], 3),
+							 "latency_ms": histogram}
+		return {"seconds": round(seconds, 3),
+				"finished": self.finished is not None,
+				"rows": self.rows,
+				"rows_per_sec": round(self.rows / seconds, 1) if seconds else None,
+				"commits": self.commits,
+				"db_seconds": round(dbseconds, 3),
+				"python_seconds": round(max(seconds - dbseconds, 0), 3),
+				"engines": engines}
+
+
+class Metrics(object):
+	""" statement counts, latencies, commits and row counts per phase, reported as JSON to path """
+
+	def __init__(self, path, interval=60):
+		self.path = path
+		self.interval = interval
+		self.started = time.time()
+		self.written = self.started
+		self.phases = {}
+		self.order = []
+		self.lock = threading.RLock()
+		self.current = threading.local()
+
+	def attach(self, engine, name):
+		""" record what goes over engine under name ("old", "new") """
+		def before(conn, cursor, statement, parameters, context, executemany):
+			conn.info.setdefault("metrics_started", []).append(time.time())
+
+		def after(conn, cursor, statement, parameters, context, executemany):
+			elapsed = time.time() - conn.info["metrics_started"].pop()
+			phase = self.phase()
+			if phase is None:
+				return
+			with self.lock:
+				stats = phase.engine(name)
+				stats["statements"] += 1
+				stats["seconds"] += elapsed
+				stats["latency_ms"][bucket(elapsed * 1000)] += 1
+			self.tick()
+
+		def commit(conn):
+			phase = self.phase()
+			if phase is not None:
+				with self.lock:
+					phase.commits += 1
+
+		event.listen(engine, "before_cursor_execute", before)
+		event.listen(engine, "after_cursor_execute", after)
+		event.listen(engine, "commit", commit)
+
+	def phase(self):
+		""" metrics of the phase the current thread is working on """
+		name = getattr(self.current, "phase", None)
+		return self.phases.get(name) if name is not None else None
+
+	@contextmanager
+	def measure(self, name):
+		""" time phase name, and attribute everything done by this thread inside the block to it """
+		with self.lock:
+			if name not in self.phases:
+				self.phases[name] = PhaseMetrics()
+				self.order.append(name)
+		try:
+			with self.within(name):
+				yield self.phases[name]
+		finally:
+			self.phases[name].finished = time.time()
+			self.write()
+
+	@contextmanager
+	def within(self, name):
+		""" attribute everything done by this thread inside the block to phase name,
+		for the helper threads of a phase being measured
+		"""
+		previous = getattr(self.current, "phase", None)
+		self.current.phase = name
+		try:
+			yield
+		finally:
+			self.current.phase = previous
+
+	def counted(self, rows, every=1000):
+		""" pass rows through, counting them towards the current phase. several threads
+		count towards a phase at once, so the count is kept here and added to the phase's
+		under the lock every so many rows (and at the end)
+		"""
+		count = 0
+		phase = None
+		try:
+			for row in rows:
+				current = self.phase()
+				if current is not phase:
+					self.add_rows(phase, count)
+					phase, count = current, 0
+				count += 1
+				if count >= every:
+					self.add_rows(phase, count)
+					count = 0
+				yield row
+		finally:
+			self.add_rows(phase, count)
+
+	def add_rows(self, phase, count):
+		if phase is not None and count:
+			with self.lock:
+				phase.rows += count
+
+	def tick(self):
+		""" write the report if it hasn't been for interval seconds """
+		if time.time() - self.written >= self.interval:
+			self.write()
+
+	def report(self):
+		with self.lock:
+			return {"started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+					"seconds": round(time.time() - self.started, 3),
+					"phases": [dict(phase=name, **self.phases[name].report()) for name in self.order]}
+
+	def write(self):
+		""" (re)write the JSON report, atomically so a reader never sees half of it """
+		if self.path is None:
+			return
+		report = self.report()
+		with self.lock:
+			self.written = time.time()
+			with open(self.path + ".tmp", "w") as f:
+				json.dump(report, f, indent=2)
+			os.rename(self.path + ".tmp", self.path)
+
+
+def bucket(ms):
+	""" index of the latency histogram bucket ms falls in """
+	for i, bound in enumerate(BUCKETS):
+		if ms <= bound:
+			return i
+	return len(BUCKETS)
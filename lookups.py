@@ -0,0 +1,361 @@
+""" lookups.py | in-memory indexes of the new handbook's reference tables
+
+Building city/zipcode relationships used to cost a query per city (zipcodes by
+city name), per merged city (the city by name and state, then its team) and per
+OMS zipcode row (the zipcode by code) -- tens of thousands of point queries
+against tables that are small and don't change while we migrate. These load
+bf_zipcode, bf_city and bf_team once, one scan each, into dicts.
+
+Keys are matched the way MySQL's default collation compares the columns they
+replace the queries on: case-insensitively, ignoring trailing spaces.
+
+NaturalKeys does the same for the rows a previous run already migrated, so that
+a rerun can tell them apart from new ones without a query per row.
+
+CityMatcher indexes bf_city for matching names typed by hand (OMS distributorship
+names) against it: normalized -- case, spacing, punctuation, "St."/"Saint" and
+"Tenn."/"Tennessee"/"TN" don't matter -- for an exact match in a dict lookup, with
+a bounded edit distance search among the cities sharing trigrams with a name when
+there's none.
+
+Accounts holds the usernames and emails bf_users has taken, so the accounts a run
+is about to create can be given free ones all at once, before anything is written,
+rather than one of them failing its insert halfway through the run.
+"""
+
+import hashlib
+import threading
+
+from collections import Counter, defaultdict
+
+from sqlalchemy import select
+
+from batchload import primary_key
+
+
+def fold(value):
+	""" a string key the way a case-insensitive, PAD SPACE collation sees it """
+	return value.rstrip().lower() if value is not None else None
+
+
+class ZipCodes(object):
+	""" bf_zipcode, indexed by city name and by zip code """
+
+	def __init__(self, engine, table):
+		self.by_city = defaultdict(list)
+		self.by_zip = {}
+		for id, zip_code, city in engine.execute(select([table.c.id, table.c.zip_code, table.c.city])):
+			self.by_city[fold(city)].append((id, zip_code))
+			self.by_zip[fold(zip_code)] = id
+
+	def in_city(self, name):
+		""" (id, zip code) of every zipcode of the city called name """
+		return self.by_city.get(fold(name), [])
+
+	def id(self, zip_code):
+		""" id of zip_code, KeyError if there's no such zipcode """
+		return self.by_zip[fold(zip_code)]
+
+
+class Cities(object):
+	""" bf_city indexed by (name, state), and bf_team by the city it's assigned to """
+
+	def __init__(self, engine, citytable, teamtable):
+		self.by_name = {}
+		self.teams = {}
+		for city_id, name, state in engine.execute(select([citytable.c.city_id, citytable.c.city_name,
+														   citytable.c.city_state])):
+			self.by_name[(fold(name), fold(state))] = city_id
+		for team_id, city_id in engine.execute(select([teamtable.c.team_id, teamtable.c.team_assigned_city])):
+			self.teams[city_id] = team_id
+
+	def city(self, name, state):
+		""" id of the city called name in state, KeyError if there isn't one """
+		return self.by_name[(fold(name), fold(state))]
+
+	def has(self, name, state):
+		""" whether there's a city called name in state """
+		return (fold(name), fold(state)) in self.by_name
+
+	def team(self, city_id):
+		""" id of the team assigned to city_id, KeyError if there isn't one """
+		return self.teams[city_id]
+
+	def add(self, city_id, name, state, team_id=None):
+		""" keep the index current with a city (and team) we just created """
+		self.by_name[(fold(name), fold(state))] = city_id
+		if team_id is not None:
+			self.teams[city_id] = team_id
+
+
+# state names (as normalize() has them) -> their two letter abbreviations
+STATES = dict((name, abbreviation) for abbreviation, name in [
+	("al", "alabama"), ("ak", "alaska"), ("az", "arizona"), ("ar", "arkansas"), ("ca", "california"),
+	("co", "colorado"), ("ct", "connecticut"), ("de", "delaware"), ("dc", "districtofcolumbia"),
+	("fl", "florida"), ("ga", "georgia"), ("hi", "hawaii"), ("id", "idaho"), ("il", "illinois"),
+	("in", "indiana"), ("ia", "iowa"), ("ks", "kansas"), ("ky", "kentucky"), ("la", "louisiana"),
+	("me", "maine"), ("md", "maryland"), ("ma", "massachusetts"), ("mi", "michigan"), ("mn", "minnesota"),
+	("ms", "mississippi"), ("mo", "missouri"), ("mt", "montana"), ("ne", "nebraska"), ("nv", "nevada"),
+	("nh", "newhampshire"), ("nj", "newjersey"), ("nm", "newmexico"), ("ny", "newyork"),
+	("nc", "northcarolina"), ("nd", "northdakota"), ("oh", "ohio"), ("ok", "oklahoma"), ("or", "oregon"),
+	("pa", "pennsylvania"), ("ri", "rhodeisland"), ("sc", "southcarolina"), ("sd", "southdakota"),
+	("tn", "tennessee"), ("tx", "texas"), ("ut", "utah"), ("vt", "vermont"), ("va", "virginia"),
+	("wa", "washington"), ("wv", "westvirginia"), ("wi", "wisconsin"), ("wy", "wyoming"),
+	("pr", "puertorico")])
+# the usual short forms of them
+STATES.update([("ala", "al"), ("ariz", "az"), ("ark", "ar"), ("calif", "ca"), ("cal", "ca"), ("colo", "co"),
+			   ("conn", "ct"), ("del", "de"), ("fla", "fl"), ("ill", "il"), ("ind", "in"), ("kan", "ks"),
+			   ("mass", "ma"), ("mich", "mi"), ("minn", "mn"), ("miss", "ms"), ("neb", "ne"), ("nev", "nv"),
+			   ("okla", "ok"), ("ore", "or"), ("penn", "pa"), ("tenn", "tn"), ("tex", "tx"), ("wash", "wa"),
+			   ("wis", "wi"), ("wyo", "wy")])
+STATES.update((abbreviation, abbreviation) for abbreviation in STATES.values())
+ABBREVIATIONS = set(STATES.values())
+
+# words spelled out before a city name is normalized, so "St. Louis" is "Saint Louis"
+WORDS = {"st": "saint", "ste": "sainte", "ft": "fort", "mt": "mount", "pt": "point"}
+
+
+def normalize(value):
+	""" a city name as it's matched: lowercase letters and digits only, with the usual
+	abbreviations spelled out
+	"""
+	words = "".join(char if char.isalnum() else " " for char in (value or "").lower()).split()
+	return "".join(WORDS.get(word, word) for word in words)
+
+def normalize_state(value):
+	""" a state as it's matched: its two letter abbreviation, lowercase, if it's one we know """
+	state = normalize(value)
+	return STATES.get(state, state)
+
+def trigrams(name):
+	""" the three letter pieces of a normalized name, the ends marked """
+	padded = "^" + name + "$"
+	return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def distance(a, b, limit):
+	""" the edit distance between a and b, or limit + 1 as soon as it's clear it's more than limit """
+	if abs(len(a) - len(b)) > limit:
+		return limit + 1
+	previous = range(len(b) + 1)
+	for i, char in enumerate(a):
+		current = [i + 1]
+		for j, other in enumerate(b):
+			current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (char != other)))
+		if min(current) > limit:
+			return limit + 1
+		previous = current
+	return min(previous[-1], limit + 1)
+
+
+class CityMatcher(Cities):
+	""" Cities, also indexed by normalized name and state, to match the names of cities
+	written out by hand (and so spelled every which way) against
+	"""
+
+	def __init__(self, engine, citytable, teamtable, max_distance=2, candidates=10):
+		Cities.__init__(self, engine, citytable, teamtable)
+		self.max_distance = max_distance # most edits a fuzzy match may take
+		self.candidates = candidates # most cities a fuzzy match looks at
+		self.normalized = {} # (name, state) -> city id
+		self.grams = defaultdict(lambda: defaultdict(set)) # state -> trigram -> names
+		# the lowest city id first, so of cities that only differ in spelling the oldest is matched
+		for (name, state), city_id in sorted(self.by_name.items(), key=lambda item: item[1]):
+			self.index(city_id, name, state)
+
+	def index(self, city_id, name, state):
+		key = (normalize(name), normalize_state(state))
+		if key not in self.normalized:
+			self.normalized[key] = city_id
+			for gram in trigrams(key[0]):
+				self.grams[key[1]][gram].add(key[0])
+
+	def add(self, city_id, name, state, team_id=None):
+		Cities.add(self, city_id, name, state, team_id)
+		self.index(city_id, name, state)
+
+	def match(self, name, state):
+		""" (id, edits) of the city in state called name -- or, if there's none, of the one
+		whose name is fewest edits away (up to max_distance, fewer for short names) among
+		the candidates sharing the most trigrams with it. (None, None) if there's no such
+		city, or two are just as close
+		"""
+		name, state = normalize(name), normalize_state(state)
+		if (name, state) in self.normalized:
+			return self.normalized[(name, state)], 0
+		limit = min(self.max_distance, len(name) // 4)
+		if not limit or state not in self.grams:
+			return None, None
+
+		shared = Counter()
+		for gram in trigrams(name):
+			shared.update(self.grams[state].get(gram, ()))
+		best, ties = None, []
+		for candidate, count in shared.most_common(self.candidates):
+			edits = distance(name, candidate, limit)
+			if edits > limit:
+				continue
+			if best is None or edits < best:
+				best, ties = edits, [candidate]
+			elif edits == best:
+				ties.append(candidate)
+		if len(ties) != 1:
+			return None, None
+		return self.normalized[(ties[0], state)], best
+
+
+class Accounts(object):
+	""" the usernames and emails of bf_users, for handing out ones that are still free """
+
+	def __init__(self, engine, table):
+		self.usernames = set()
+		self.emails = {} # email -> the username it goes with
+		for username, email in engine.execute(select([table.c.username, table.c.email])):
+			if username:
+				self.usernames.add(fold(username))
+			if email:
+				self.emails[fold(email)] = username
+
+	def resolve(self, accounts, reuse_emails=False):
+		""" free usernames and emails for accounts, (id, username, email) of the accounts
+		about to be created. they're taken in id order, each keeping its own if nothing
+		before it (in bf_users or among accounts) has it, or else getting it with the
+		lowest number that's free added (lindasmith2, linda+2@example.com) -- so the
+		same accounts against the same bf_users always come out the same. with
+		reuse_emails an account whose email is in bf_users is the row a previous run
+		wrote for it (to be updated, not written again), and keeps it along with the
+		username that row has.
+
+		returns id -> (username, email) of the accounts whose names had to change, and
+		a report of each change: (id, field, wanted, given, taken by -- "bf_users", or
+		the id of the account that had it first)
+		"""
+		renamed = {}
+		report = []
+		taken = {"username": dict((name, "bf_users") for name in self.usernames),
+				 "email": dict((email, "bf_users") for email in self.emails)}
+		reused = set()
+		for id, username, email in sorted(accounts):
+			if reuse_emails and email and fold(email) in self.emails and fold(email) not in reused:
+				reused.add(fold(email))
+				if self.emails[fold(email)] != username:
+					renamed[id] = (self.emails[fold(email)], email)
+				continue
+			given = {}
+			for field, wanted in (("username", username), ("email", email)):
+				given[field] = wanted
+				if not wanted:
+					continue
+				n = 1
+				while fold(given[field]) in taken[field]:
+					n += 1
+					given[field] = numbered(wanted, n)
+				if n > 1:
+					report.append((id, field, wanted, given[field], taken[field][fold(wanted)]))
+				taken[field][fold(given[field])] = id
+			if (given["username"], given["email"]) != (username, email):
+				renamed[id] = (given["username"], given["email"])
+		return renamed, report
+
+
+def write_collisions(path, report):
+	""" write the report of Accounts.resolve() to path, a tab separated line per change """
+	with open(path, "w") as f:
+		f.write("old id\tfield\twanted\tgiven\ttaken by\n")
+		for row in report:
+			f.write("\t".join(value.encode("utf-8") if isinstance(value, unicode) else str(value)
+							   for value in row) + "\n")
+
+def numbered(value, n):
+	""" value with n added: at the end, or for an email (or a username that is one) to
+	the part before the @, as a +tag, which mail still gets delivered under
+	"""
+	if "@" in value:
+		local, domain = value.rsplit("@", 1)
+		return local+"+"+str(n)+"@"+domain
+	return value+str(n)
+
+
+class NaturalKeys(object):
+	""" the rows a new handbook table has (when it's read) by natural key, the values of
+	columns: natural key -> primary key(s). only a digest of each key is kept, so even
+	bf_contacts fits in memory. rows whose natural key is empty (all NULL or '') are
+	never matched.
+
+	each row is handed out once: rows sharing a natural key (a bfa contact linked to
+	two members of a team is written twice) are matched to the rows with it in turn, in
+	the order they were written in, the way a first run wrote them
+	"""
+
+	def __init__(self, engine, table, columns):
+		self.columns = columns
+		self.ids = {} # a single id, or a list of them when several rows share a key
+		self.count = 0
+		self.lock = threading.Lock()
+		pk = primary_key(table)
+		for row in engine.execute(select([pk] + [table.c[column] for column in columns]).order_by(pk)):
+			key = natural_key(row[1:])
+			if key is not None:
+				self.append(key, row[0])
+				self.count += 1
+
+	def key(self, row):
+		""" the natural key of row, a dict of our columns (those it doesn't have count as NULL) """
+		return natural_key([row.get(column) for column in self.columns])
+
+	def append(self, key, id):
+		ids = self.ids.get(key)
+		if ids is None:
+			self.ids[key] = id
+		elif isinstance(ids, list):
+			ids.append(id)
+		else:
+			self.ids[key] = [ids, id]
+
+	def take(self, rows):
+		""" for each of rows (dicts), the primary key of a row already in the table with its
+		natural key that hasn't been handed out yet, or None
+		"""
+		taken = []
+		with self.lock:
+			for row in rows:
+				key = self.key(row)
+				ids = self.ids.get(key)
+				if isinstance(ids, list):
+					taken.append(ids.pop(0))
+					if len(ids) == 1:
+						self.ids[key] = ids[0]
+				else:
+					taken.append(ids)
+					if ids is not None:
+						del self.ids[key]
+		return taken
+
+	def give_back(self, rows, ids):
+		""" undo take(rows), which returned ids (for a write that was rolled back) """
+		with self.lock:
+			for row, id in reversed(zip(rows, ids)):
+				if id is not None:
+					key = self.key(row)
+					ids = self.ids.get(key)
+					if ids is None:
+						self.ids[key] = id
+					elif isinstance(ids, list):
+						ids.insert(0, id)
+					else:
+						self.ids[key] = [id, ids]
+
+
+def natural_key(values):
+	""" a natural key made of values, the same whichever way a driver hands them back.
+	None if they're all empty
+	"""
+	if all(value is None or value == "" for value in values):
+		return None
+	parts = []
+	for value in values:
+		if isinstance(value, basestring):
+			value = fold(value)
+			if isinstance(value, unicode):
+				value = value.encode("utf-8")
+		parts.append("\\N" if value is None else str(value))
+	return hashlib.sha1("\t".join(parts)).digest()
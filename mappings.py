@@ -0,0 +1,47 @@
+""" mappings.py | the columns an old handbook row brings over, shared by the migration scripts
+
+hbmigrate.py migrates whole handbooks and hbmigratenew.py the contacts and comments
+of a few cities, but an old contact or comment becomes the same new row either
+way. The fields copied over live here, once, and each script builds its
+rowmap.Mappings on top of them with the foreign keys and id mappings of its own.
+"""
+
+import datetime
+
+from rowmap import Mapper, Mapping
+
+
+# bf_contacts columns taken from an old contact
+build_contact = Mapper([("contacts_firstname", "first_name"),
+						("contacts_lastname", "last_name"),
+						("contacts_email", "email"),
+						("contacts_phone", "phone"),
+						("contacts_gender", "gender"),
+						("contacts_address", "address"),
+						("contacts_city", "addr_city"),
+						("contacts_state", "state"),
+						("contacts_zip", "zip"),
+						("date_met", "datemet")])
+
+# bf_contacts columns copied as they are from an old bfa contact
+bfa_contact_columns = Mapper([("contacts_firstname", "first_name"),
+							  ("contacts_lastname", "last_name"),
+							  ("contacts_email", "email"),
+							  ("contacts_phone", "phone"),
+							  ("contacts_address", "address"),
+							  ("contacts_city", "addr_city"),
+							  ("contacts_state", "state"),
+							  ("contacts_zip", "zip"),
+							  ("biblestudy_interest", "bfa_wantbiblestudy"),
+							  ("contacts_books", "bfa_orderitems"),
+							  ("customer_id", "bfa_customerid")])
+
+# the day an old bfa contact ordered on
+ordered_on = ("oms_date_ordered", lambda bfacontact: datetime.datetime.date(bfacontact.bfa_dateordered))
+
+# bf_contacts columns taken from an old bfa contact
+build_bfa_contact = Mapping(bfa_contact_columns, computed=[ordered_on])
+
+# bf_contacts_comments columns taken from an old comment
+build_comment = Mapper([("contact_comment", "content"),
+						("date_added", "created_at")])
@@ -0,0 +1,126 @@
+""" pipeline.py | extract -> transform -> load, optionally with the stages overlapped
+
+A migration phase reads rows from the old handbook, turns each one into what
+gets written to the new one, and writes those in batches. Run strictly in turn,
+one database always sits idle while the other works. run(threaded=True) gives
+each stage its own thread instead:
+
+	reader     iterates the source rows into a bounded queue
+	transform  (the calling thread) turns them into payloads and groups them into batches
+	writer     drains the batches into the new handbook
+
+so reading the next rows overlaps with writing the last batch. Both queues are
+bounded, so a slow writer holds the reader back (and memory stays flat) rather
+than the rows piling up in between. If any stage fails the others stop and the
+error is raised again in the calling thread.
+"""
+
+import sys
+import threading
+import Queue
+
+END = object() # marks the end of a queue
+
+
+def run(rows, transform, load, batch_size, threaded=False, depth=4, context=None):
+	""" feed each row of rows() through transform() and hand the results to load()
+	in lists of up to batch_size. transform returning None drops the row.
+
+	rows is called (in the reader thread, when threaded) to get the source rows;
+	context, if given, is called in every thread for a context manager the
+	stage runs inside of (e.g. to attribute its statements to a phase).
+	"""
+	if not threaded:
+		return load_batches(batches(transform_rows(rows(), transform), batch_size), load)
+
+	stop = threading.Event()
+	failures = []
+	read = Queue.Queue(maxsize=depth * batch_size)
+	write = Queue.Queue(maxsize=depth)
+
+	def stage(work):
+		def target():
+			try:
+				if context is not None:
+					with context():
+						work()
+				else:
+					work()
+			except BaseException:
+				failures.append(sys.exc_info())
+				stop.set()
+		return target
+
+	def reader():
+		for row in rows():
+			if not put(read, row, stop):
+				return
+		put(read, END, stop)
+
+	def writer():
+		load_batches(drain(write, stop), load)
+
+	threads = [threading.Thread(target=stage(reader), name="reader"),
+			   threading.Thread(target=stage(writer), name="writer")]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+
+	def transformer():
+		for batch in batches(transform_rows(drain(read, stop), transform), batch_size):
+			if not put(write, batch, stop):
+				return
+		put(write, END, stop)
+
+	stage(transformer)()
+
+	for thread in threads:
+		thread.join()
+	if failures:
+		exc_type, exc_value, exc_traceback = failures[0]
+		raise exc_type, exc_value, exc_traceback
+
+
+def transform_rows(rows, transform):
+	""" transform(row) for each of rows, leaving out the Nones """
+	for row in rows:
+		payload = transform(row)
+		if payload is not None:
+			yield payload
+
+def batches(rows, size):
+	""" group rows into lists of up to size """
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+def load_batches(batches, load):
+	""" load() each of batches """
+	for batch in batches:
+		load(batch)
+
+def put(queue, item, stop):
+	""" queue.put(item), giving up (returning False) if stop gets set while we wait """
+	while not stop.is_set():
+		try:
+			queue.put(item, timeout=0.1)
+			return True
+		except Queue.Full:
+			pass
+	return False
+
+def drain(queue, stop):
+	""" the items of queue up to END, or until stop gets set """
+	while not stop.is_set():
+		try:
+			item = queue.get(timeout=0.1)
+		except Queue.Empty:
+			continue
+		if item is END:
+			return
+		yield item
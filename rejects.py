@@ -0,0 +1,135 @@
+""" rejects.py | the rows a migration couldn't bring over, and why
+
+A single malformed row (a contact whose city was never migrated, a value too long
+for its new column) used to either abort the whole run or vanish into migrate.log
+among thousands of other lines. Rows that fail on their own are recorded here
+instead, one tab separated line each, so the run carries on and the rejects can
+be looked at (and fixed up by hand) afterwards:
+
+	time	phase	old id	error
+
+Rows left out on purpose -- a comment on a contact that was never migrated, a
+contact member whose user is gone -- are far more common (millions of orphaned
+comments, on a big handbook), so they aren't written out one line each: they're
+counted by category (missing contact, missing user...) and their ids kept, and
+once the run is done written to a side file, a line per phase and category with
+the ids as ranges:
+
+	phase	category	rows	1-5,9,12-20
+
+Neither ever holds up the phase that reports it: add() and skip() only put the row
+on a queue, and a background thread does the writing (and logs the first few of
+each category, for a taste of them in migrate.log). close() waits for it, writes
+the side file, and the run ends with summary(), a table of the counts.
+"""
+
+import datetime
+import logging
+import threading
+import Queue
+
+from array import array
+from collections import defaultdict
+
+
+class Rejects(object):
+	""" an append-only log of rejected rows at path, and of skipped ones at path.ids """
+
+	logged = 3 # rows of each phase and category logged, the rest are only counted
+
+	def __init__(self, path):
+		self.path = path
+		self.queue = Queue.Queue()
+		self.counts = defaultdict(int) # (phase, category) -> rows
+		self.ids = defaultdict(lambda: array("l")) # (phase, category) -> their old ids
+		self.lock = threading.Lock()
+		self.closed = False
+		self.writer = threading.Thread(target=self.write, name="rejects")
+		self.writer.daemon = True
+		self.writer.start()
+
+	@property
+	def count(self):
+		""" rows rejected or skipped so far (that the writer got to) """
+		with self.lock:
+			return sum(self.counts.itervalues())
+
+	def add(self, phase, id, error):
+		""" record that source row id of phase was not migrated because of error """
+		# database errors carry the whole statement and its parameters, the driver's message is enough
+		reason = type(error).__name__+": "+" ".join(str(getattr(error, "orig", error)).split())
+		self.queue.put((phase, type(error).__name__, id, reason, datetime.datetime.now()))
+
+	def skip(self, phase, category, id):
+		""" record that source row id of phase was left out because of category (what it
+		refers to that wasn't migrated: "missing contact", "missing user"...)
+		"""
+		self.queue.put((phase, category, id, None, None))
+
+	def write(self):
+		""" the writer thread: drains the queue into the counts, ids and rejects file """
+		f = None # opened with the first reject
+		try:
+			while True:
+				item = self.queue.get()
+				if item is None:
+					break
+				phase, category, id, reason, when = item
+				key = (phase, category)
+				with self.lock:
+					self.counts[key] += 1
+				if isinstance(id, (int, long)):
+					self.ids[key].append(id)
+				if self.counts[key] <= self.logged:
+					logging.error(phase+" id#"+str(id)+" "+("rejected: "+reason if reason is not None else "skipped: "+category)
+								  +(" (no more of these are logged)" if self.counts[key] == self.logged else ""))
+				if reason is not None:
+					if f is None:
+						f = open(self.path, "a")
+					f.write("\t".join([str(when), phase, str(id), reason]) + "\n")
+				if f is not None and self.queue.empty():
+					f.flush()
+		finally:
+			if f is not None:
+				f.close()
+
+	def close(self):
+		""" wait for everything recorded to be written, and write the ids of the skipped
+		(and rejected) rows to path.ids
+		"""
+		if self.closed:
+			return
+		self.closed = True
+		self.queue.put(None)
+		self.writer.join()
+		if not self.counts:
+			return
+		with open(self.path + ".ids", "w") as f:
+			for (phase, category), ids in sorted(self.ids.iteritems()):
+				f.write("\t".join([phase, category, str(self.counts[(phase, category)]), ranges(ids)]) + "\n")
+
+	def summary(self):
+		""" the counts, as a table: a line per phase and category """
+		lines = ["%-16s %-24s %10s" % ("phase", "category", "rows")]
+		with self.lock:
+			counts = sorted(self.counts.iteritems())
+		for (phase, category), count in counts:
+			lines.append("%-16s %-24s %10d" % (phase, category, count))
+		lines.append("%-16s %-24s %10d" % ("", "total", sum(count for key, count in counts)))
+		return "\n".join(lines)
+
+
+def ranges(ids):
+	""" ids, sorted, as a string of ranges: 1-5,9,12-20 """
+	parts = []
+	start = previous = None
+	for id in sorted(set(ids)):
+		if previous is not None and id == previous + 1:
+			previous = id
+			continue
+		if start is not None:
+			parts.append(str(start) if start == previous else str(start)+"-"+str(previous))
+		start = previous = id
+	if start is not None:
+		parts.append(str(start) if start == previous else str(start)+"-"+str(previous))
+	return ",".join(parts)
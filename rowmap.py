@@ -0,0 +1,145 @@
+""" rowmap.py | old handbook rows as plain tuples, mapped straight to insert parameters
+
+Reading the old tables through their Elixir entities builds a full ORM object per
+row -- instrumented attributes, identity map, session bookkeeping -- for data
+that's read exactly once and never written back. Rows selects just the columns a
+phase needs with a Core select and hands each row out as a namedtuple record
+(attribute access, no ORM behind it). Mapper turns such a record into the
+parameter dict of a Core insert, through column positions worked out once
+instead of a getattr per column per row. Mapping declares a whole new row on top
+of that: the fields copied, the foreign keys looked up in id mappings, the columns
+that are always the same or worked out from the record, and the id mappings the
+new rows fill in -- which is all the scheduler needs to know to order the phases.
+"""
+
+from collections import namedtuple
+from operator import attrgetter, itemgetter
+
+from sqlalchemy import select
+
+
+class Rows(object):
+	""" a Core select of (field name, column) pairs whose rows come back as records.
+	the first column is what the rows are paginated (and resumed) on, so it has to be
+	unique and indexed -- in practice the primary key of the table driving the select.
+	"""
+
+	def __init__(self, name, columns, from_obj=None):
+		self.fields = [field for field, column in columns]
+		self.record = namedtuple(name, self.fields)
+		self.key = columns[0][1]
+		self.query = select([column.label(field) for field, column in columns],
+							from_obj=[from_obj] if from_obj is not None else None)
+
+	def select(self, *criteria):
+		""" the select, narrowed down by criteria """
+		query = self.query
+		for criterion in criteria:
+			query = query.where(criterion)
+		return query
+
+
+class Mapper(object):
+	""" copies fields of a record into a dict under new keys: [(key, field), ...] """
+
+	__slots__ = ("keys", "fields", "getters")
+
+	def __init__(self, mapping):
+		self.keys = tuple(key for key, field in mapping)
+		self.fields = [field for key, field in mapping]
+		self.getters = {}
+
+	def getter(self, record):
+		""" itemgetter of the positions of our fields in record's type, compiled once per type """
+		if not self.fields:
+			return lambda row: () # (a Mapping whose columns are all remapped or computed)
+		if not hasattr(record, "_fields"):
+			# not a record (an ORM object, say): by attribute then
+			if len(self.fields) == 1:
+				get = attrgetter(self.fields[0])
+				return lambda row: (get(row),)
+			return attrgetter(*self.fields)
+		positions = [record._fields.index(field) for field in self.fields]
+		if len(positions) == 1:
+			position = positions[0]
+			return lambda row: (row[position],)
+		return itemgetter(*positions)
+
+	def __call__(self, row):
+		try:
+			getter = self.getters[type(row)]
+		except KeyError:
+			getter = self.getters[type(row)] = self.getter(row)
+		return dict(zip(self.keys, getter(row)))
+
+
+class Unmapped(KeyError):
+	""" a foreign key of a row that's not in the id mapping it's looked up in """
+
+	def __init__(self, key, value):
+		KeyError.__init__(self, value)
+		self.key = key # the column it was for
+
+
+class Mapping(object):
+	""" how an old record becomes a row of a new table:
+
+		columns   a Mapper of the fields copied over
+		remaps    [(key, id mapping, field)], foreign keys looked up through id mappings
+		          -- or (key, id mapping, field, default) to fall back on default
+		values    keys that get the same value in every row
+		computed  [(key, function)], keys worked out from the record by function(record)
+		targets   [(id mapping, field, key)], the id mappings the rows fill in once
+		          they're written: the record's field -> the new row's id (key None),
+		          or the value of key in the new row
+
+	calling it on a record gives the row, or raises Unmapped if one of its foreign
+	keys was never mapped. the names of the id mappings it looks up (reads) and fills
+	in (writes) are what the phases using it are scheduled by
+	"""
+
+	__slots__ = ("columns", "remaps", "values", "computed", "targets")
+
+	REQUIRED = object() # (the default of a remap without one)
+
+	def __init__(self, columns, remaps=(), values=None, computed=(), targets=()):
+		self.columns = columns
+		self.remaps = [tuple(remap) + (self.REQUIRED,) * (4 - len(remap)) for remap in remaps]
+		self.values = values or {}
+		self.computed = list(computed)
+		self.targets = list(targets)
+
+	@property
+	def keys(self):
+		return (self.columns.keys + tuple(key for key, idmap, field, default in self.remaps)
+				+ tuple(key for key, compute in self.computed) + tuple(self.values))
+
+	@property
+	def reads(self):
+		return [idmap.name for key, idmap, field, default in self.remaps]
+
+	@property
+	def writes(self):
+		return [idmap.name for idmap, field, key in self.targets]
+
+	def __call__(self, row):
+		new = self.columns(row)
+		for key, idmap, field, default in self.remaps:
+			try:
+				new[key] = idmap[getattr(row, field)]
+			except KeyError:
+				if default is self.REQUIRED:
+					raise Unmapped(key, getattr(row, field))
+				new[key] = default
+		for key, compute in self.computed:
+			new[key] = compute(row)
+		new.update(self.values)
+		return new
+
+	def mapped(self, records, rows, ids):
+		""" name -> [(old id, new id)] for each of the targets, for records written as rows
+		that were given ids
+		"""
+		return dict((idmap.name, [(getattr(record, field), id if key is None else row[key])
+								  for record, row, id in zip(records, rows, ids)])
+					for idmap, field, key in self.targets)
@@ -0,0 +1,134 @@
+""" schedule.py | migration phases run in dependency order, the independent ones side by side
+
+The migration scripts used to be straight-line module code, each phase called
+after the one before it whether it needed its results or not. The order only
+really matters through the id mappings: a phase that looks old ids up in
+city2team has to wait for the one filling city2team in, and for nothing else.
+
+So a phase declares the mappings it reads and writes -- through the
+rowmap.Mappings it builds its rows with, whose remaps and targets say as much --
+the dependencies are worked out from those (a phase depends on every phase that
+writes a mapping it reads), and run() starts each phase as soon as the ones it
+depends on are done -- up to workers at a time, each in a thread of its own.
+With one worker the phases run one after the other in the order they were
+declared in, as before.
+"""
+
+import logging
+import sys
+import threading
+import Queue
+
+
+class Phase(object):
+	""" a step of a migration:
+
+		name      what it's checkpointed, measured and logged as
+		run       does the work
+		reads     names of the id mappings it looks old ids up in
+		writes    names of the id mappings it fills in
+		mappings  rowmap.Mappings it builds rows with, adding the id mappings they
+		          remap through to reads and those they fill in to writes
+	"""
+
+	def __init__(self, name, run, reads=(), writes=(), mappings=()):
+		self.name = name
+		self.run = run
+		self.reads = unique(list(reads) + [idmap for mapping in mappings for idmap in mapping.reads])
+		self.writes = unique(list(writes) + [idmap for mapping in mappings for idmap in mapping.writes])
+
+	def __repr__(self):
+		return "<Phase "+self.name+">"
+
+
+def unique(names):
+	""" names without repeats, in the order they first come in """
+	unique = []
+	for name in names:
+		if name not in unique:
+			unique.append(name)
+	return unique
+
+def dependencies(phases):
+	""" name -> set of the names of the phases it depends on """
+	writers = {}
+	for phase in phases:
+		for idmap in phase.writes:
+			writers.setdefault(idmap, set()).add(phase.name)
+	# a mapping nobody here writes was filled in by an earlier run (or another script)
+	return dict((phase.name, set(name for idmap in phase.reads for name in writers.get(idmap, ())) - set([phase.name]))
+				for phase in phases)
+
+def order(phases):
+	""" phases in an order that runs every phase after the ones it depends on, as close
+	to the declared order as that allows. ValueError if they depend on each other in a circle
+	"""
+	waiting = dependencies(phases)
+	ordered = []
+	pending = list(phases)
+	while pending:
+		ready = [phase for phase in pending if not waiting[phase.name]]
+		if not ready:
+			raise ValueError("phases depend on each other in a circle: "+", ".join(phase.name for phase in pending))
+		ordered.append(ready[0])
+		pending.remove(ready[0])
+		for names in waiting.itervalues():
+			names.discard(ready[0].name)
+	return ordered
+
+
+def run(phases, execute=None, workers=1):
+	""" execute(phase) (phase.run() by default) for every phase, each once the phases
+	it depends on are done, up to workers at a time. after a failure no more phases
+	are started; once the running ones are done the first failure is raised again
+	"""
+	if execute is None:
+		execute = lambda phase: phase.run()
+	ordered = order(phases)
+	if workers <= 1:
+		for phase in ordered:
+			execute(phase)
+		return
+
+	waiting = dependencies(phases)
+	pending = list(phases) # the declared order, so ties start in it
+	running = set()
+	finished = Queue.Queue()
+	failures = []
+
+	def target(phase):
+		try:
+			execute(phase)
+			finished.put((phase, None))
+		except BaseException:
+			finished.put((phase, sys.exc_info()))
+
+	while pending or running:
+		if not failures:
+			for phase in [phase for phase in pending if not waiting[phase.name]][:workers - len(running)]:
+				pending.remove(phase)
+				running.add(phase.name)
+				if running - set([phase.name]):
+					logging.info("### starting "+phase.name+" alongside "+", ".join(sorted(running - set([phase.name])))+" ###")
+				thread = threading.Thread(target=target, args=(phase,), name=phase.name)
+				thread.daemon = True
+				thread.start()
+		if not running:
+			break
+
+		try:
+			# (with a timeout, or the wait can't be interrupted)
+			phase, failure = finished.get(timeout=1)
+		except Queue.Empty:
+			continue
+		running.discard(phase.name)
+		if failure is not None:
+			logging.error("### "+phase.name+" failed, not starting any more phases ###")
+			failures.append(failure)
+		else:
+			for names in waiting.itervalues():
+				names.discard(phase.name)
+
+	if failures:
+		exc_type, exc_value, exc_traceback = failures[0]
+		raise exc_type, exc_value, exc_traceback
@@ -0,0 +1,75 @@
+""" schemacache.py | reflected table definitions, cached on local disk
+
+Every entity in the migration scripts is `autoload=True`, so setup_all() reflects
+each table over the network before a single row moves -- a few round-trips per
+table, about 20 tables, on every start.
+
+load_schema() reflects the tables once, pickles the resulting MetaData to a local
+file along with a fingerprint of the schema, and on later starts copies the cached
+tables straight into the scripts' metadata. Elixir's autoload then finds them
+already defined and doesn't reflect again. The fingerprint costs one query (the
+column definitions from information_schema), so any schema change -- a new column,
+a changed type, a new key -- is picked up and the cache rebuilt.
+"""
+
+import cPickle as pickle
+import hashlib
+import logging
+
+from sqlalchemy import MetaData, text
+
+
+def fingerprint(engine, tables):
+	""" a checksum of how the database describes tables' columns and keys """
+	if engine.dialect.name == "sqlite":
+		rows = engine.execute(text("SELECT tbl_name, type, name, sql FROM sqlite_master "
+								   "WHERE type IN ('table', 'index') ORDER BY tbl_name, type, name"))
+	else:
+		rows = engine.execute(text("SELECT table_name, column_name, column_type, is_nullable, "
+								   "column_default, column_key, extra FROM information_schema.columns "
+								   "WHERE table_schema = DATABASE() ORDER BY table_name, ordinal_position"))
+
+	checksum = hashlib.sha1()
+	for row in rows:
+		if row[0] in tables:
+			checksum.update(repr(tuple(row)))
+	return checksum.hexdigest()
+
+
+def load_schema(metadata, engine, tables, path):
+	""" define tables in metadata, from the cache at path if the schema hasn't changed
+	since it was written, reflecting them from engine (and rewriting the cache) if it has.
+	with no engine (no database to check against, e.g. running off a snapshot) the
+	cache is taken as it is
+	"""
+	if engine is None:
+		with open(path, "rb") as f:
+			cachedkey, cached = pickle.load(f)
+		copy_tables(cached, metadata)
+		return
+
+	key = fingerprint(engine, tables)
+
+	cached = None
+	try:
+		with open(path, "rb") as f:
+			cachedkey, cached = pickle.load(f)
+		if cachedkey != key:
+			logging.info("schema of "+str(engine.url)+" changed, reflecting it again")
+			cached = None
+	except (IOError, EOFError, pickle.UnpicklingError):
+		pass # no (usable) cache yet
+
+	if cached is None:
+		cached = MetaData()
+		cached.reflect(bind=engine, only=tables)
+		with open(path, "wb") as f:
+			pickle.dump((key, cached), f, pickle.HIGHEST_PROTOCOL)
+
+	copy_tables(cached, metadata)
+
+def copy_tables(cached, metadata):
+	""" define the tables of cached in metadata, unless they already are """
+	for table in cached.sorted_tables:
+		if table.key not in metadata.tables:
+			table.tometadata(metadata)
@@ -0,0 +1,121 @@
+""" snapshot.py | source rows dumped to local files, to rehearse a migration offline
+
+Every rehearsal of the transform logic used to read the source database live,
+loading that box and paying the network for the same rows again and again. An
+extract step writes the rows each phase reads into a snapshot file once; later
+runs stream them back from local disk instead.
+
+A snapshot file is
+
+	MAGIC
+	length-prefixed pickle of the field names
+	blocks, each: length, first key, last key, then zlib-compressed pickle of a
+	list of up to block_size row tuples
+
+so it's compact, is read through mmap (repeated runs come out of the page
+cache), and resuming after a key skips whole blocks without decompressing them.
+The key is the first field of every row, as for streaming.stream_rows().
+"""
+
+import cPickle as pickle
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = "HBSNAP1\n"
+LENGTH = struct.Struct(">I")
+BLOCK = struct.Struct(">Iqq") # compressed length, first key, last key
+
+
+def write(path, fields, rows, block_size=5000):
+	""" dump rows (tuples of fields, in key order) to a snapshot file at path,
+	returns the number of rows written. ValueError if the keys aren't ascending (reading
+	the snapshot back skips blocks and stops ranges by key), leaving no file behind
+	"""
+	count = 0
+	last = None
+	try:
+		with open(path + ".tmp", "wb") as f:
+			f.write(MAGIC)
+			header = pickle.dumps(list(fields), pickle.HIGHEST_PROTOCOL)
+			f.write(LENGTH.pack(len(header)))
+			f.write(header)
+
+			block = []
+			for row in rows:
+				if last is not None and not row[0] > last:
+					raise ValueError(path+": key "+str(row[0])+" comes after "+str(last)
+									 +", the rows have to be in ascending key order")
+				last = row[0]
+				block.append(tuple(row))
+				if len(block) >= block_size:
+					count += write_block(f, block)
+					block = []
+			if block:
+				count += write_block(f, block)
+	except:
+		os.remove(path + ".tmp")
+		raise
+	os.rename(path + ".tmp", path) # only a complete snapshot ever goes by its name
+	return count
+
+def write_block(f, block):
+	data = zlib.compress(pickle.dumps(block, pickle.HIGHEST_PROTOCOL))
+	f.write(BLOCK.pack(len(data), block[0][0], block[-1][0]))
+	f.write(data)
+	return len(block)
+
+
+def read(path, after=None, make=tuple):
+	""" the rows of the snapshot file at path, each handed out as make(row), leaving
+	out those with a key up to and including after
+	"""
+	with open(path, "rb") as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		offset = header(data, path)[1]
+		while offset < len(data):
+			length, first, last = BLOCK.unpack_from(data, offset)
+			offset += BLOCK.size
+			if after is None or last > after:
+				for row in pickle.loads(zlib.decompress(data[offset:offset + length])):
+					if after is None or row[0] > after:
+						yield make(row)
+			offset += length
+	finally:
+		data.close()
+
+def bounds(path):
+	""" (first key, last key) of the rows in the snapshot file at path, (None, None) if it has none """
+	with open(path, "rb") as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		offset = header(data, path)[1]
+		first = last = None
+		while offset < len(data):
+			length, start, end = BLOCK.unpack_from(data, offset)
+			if first is None:
+				first = start
+			last = end
+			offset += BLOCK.size + length
+		return first, last
+	finally:
+		data.close()
+
+def fields(path):
+	""" the field names of the rows in the snapshot file at path """
+	with open(path, "rb") as f:
+		start = f.read(len(MAGIC) + LENGTH.size)
+		if start[:len(MAGIC)] != MAGIC:
+			raise ValueError(path+" is not a snapshot")
+		length, = LENGTH.unpack_from(start, len(MAGIC))
+		return pickle.loads(f.read(length))
+
+def header(data, path):
+	""" (field names, offset of the first block) """
+	if data[:len(MAGIC)] != MAGIC:
+		raise ValueError(path+" is not a snapshot")
+	length, = LENGTH.unpack_from(data, len(MAGIC))
+	start = len(MAGIC) + LENGTH.size
+	return pickle.loads(data[start:start + length]), start + length
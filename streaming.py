@@ -0,0 +1,73 @@
+""" streaming.py | chunked reads from the old handbook tables
+
+`Entity.query.all()` materializes a whole table as identity-mapped ORM objects
+before the first row gets written. `stream()` instead walks a query in id order
+one chunk at a time (keyset pagination: WHERE id > last ORDER BY id LIMIT n),
+and drops each chunk from the session once it has been handed out, so memory
+stays bounded by the chunk size no matter how big the table is.
+`stream_rows()` does the same for a Core select, without a session at all.
+"""
+
+
+def stream(query, column, chunk_size=1000):
+	""" yield the rows of query, chunk_size at a time, paginated on column
+
+	column must be unique and indexed (in practice: the table's primary key). for
+	queries that return several entities per row it has to belong to the first one.
+	a chunk_size of 0 (or None) falls back to loading everything at once (in column order).
+	"""
+	if not chunk_size:
+		for row in query.order_by(column).all():
+			yield row
+		return
+
+	last = None
+	while True:
+		chunk = query
+		if last is not None:
+			chunk = chunk.filter(column > last)
+		chunk = chunk.order_by(column).limit(chunk_size).all()
+		if not chunk:
+			return
+		last = chunk[-1]
+		if isinstance(last, tuple):
+			last = last[0]
+		last = getattr(last, column.key)
+
+		for row in chunk:
+			yield row
+
+		# everything in this chunk has been consumed, let it go
+		query.session.expunge_all()
+		if len(chunk) < chunk_size:
+			return
+
+
+def stream_rows(engine, query, column, make=tuple, chunk_size=1000):
+	""" the rows of a Core select, chunk_size at a time, paginated on column, each
+	handed out as make(row)
+
+	like stream(), but with no session or ORM objects involved. column has to be the
+	first column of the select.
+	"""
+	if not chunk_size:
+		# still in column order: resuming, snapshots and partitions go by the last key handed out
+		for row in engine.execute(query.order_by(column)):
+			yield make(row)
+		return
+
+	last = None
+	while True:
+		chunk = query
+		if last is not None:
+			chunk = chunk.where(column > last)
+		chunk = engine.execute(chunk.order_by(column).limit(chunk_size)).fetchall()
+		if not chunk:
+			return
+		last = chunk[-1][0]
+
+		for row in chunk:
+			yield make(row)
+
+		if len(chunk) < chunk_size:
+			return
@@ -0,0 +1,93 @@
+""" throttle.py | keeping the migration from starving the live new handbook
+
+The new handbook serves live traffic while the migration scripts write into it.
+Writing flat out holds locks longer and lets replication fall behind, so Throttle
+paces the writes instead: it times each write transaction against the new db and
+
+	- shrinks the batch (and backs off with a growing pause between batches) while
+	  transactions take longer than the target latency
+	- grows the batch again (and drops the pause) while they're comfortably under it
+	- on top of that, never lets the rows written go faster than a rows/sec ceiling
+
+One Throttle is shared by every thread writing (the ranges of --partitions, the
+phases of --phase-workers), and the ceiling is on all their rows together: each
+write takes its rows' share of the time the ceiling allows after the shares the
+writes before it took, whichever thread they came from -- a token bucket refilled
+at the ceiling, holding no more than a write's worth -- and waits until its share
+is over. The batch size and pause adapt under the same lock.
+
+A Throttle with neither a target latency nor a ceiling doesn't get in the way.
+"""
+
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class Throttle(object):
+	""" adapts batch size and inter-batch delay to the measured write latency.
+	safe to share between threads
+	"""
+
+	def __init__(self, target_latency=None, max_rate=None, min_batch=10, max_batch=500, max_delay=5.0):
+		self.target_latency = target_latency # seconds a write transaction should take at most
+		self.max_rate = max_rate # rows per second
+		self.min_batch = min(min_batch, max_batch)
+		self.max_batch = max_batch
+		self.max_delay = max_delay
+		# with a latency to hold, start small and work our way up
+		self.size = max(self.min_batch, max_batch // 5) if target_latency else max_batch
+		self.delay = 0.0
+		self.paused = 0.0
+		self.lock = threading.Lock()
+		self.until = 0.0 # when the rows let through so far have taken the time max_rate allows them
+
+	@property
+	def enabled(self):
+		return bool(self.target_latency or self.max_rate)
+
+	def pace(self, rows, seconds):
+		""" adjust to a write of rows that took seconds, then wait before the next one """
+		with self.lock:
+			if self.target_latency:
+				size, delay = self.size, self.delay
+				if seconds > self.target_latency:
+					self.size = max(self.min_batch, self.size // 2)
+					self.delay = min(self.max_delay, max(self.delay * 2, 0.05))
+				elif seconds < self.target_latency / 2:
+					self.size = min(self.max_batch, int(self.size * 1.25) + 1)
+					self.delay = self.delay / 2 if self.delay > 0.01 else 0.0
+				if (size, delay) != (self.size, self.delay):
+					logging.debug("throttle: write of "+str(rows)+" rows took "+str(round(seconds, 3))+"s, batch size now "
+								  +str(self.size)+", delay "+str(round(self.delay, 3))+"s")
+
+			pause = self.delay
+			if self.max_rate:
+				now = time.time()
+				# (time nobody wrote in isn't saved up for a burst later)
+				self.until = max(self.until, now - seconds) + float(rows) / self.max_rate
+				pause = max(pause, self.until - now)
+			if pause > 0:
+				self.paused += pause
+		if pause > 0:
+			time.sleep(pause)
+
+	@contextmanager
+	def timed(self, rows):
+		""" time the write of rows done inside the block, and pace the next one """
+		started = time.time()
+		yield
+		self.pace(rows, time.time() - started)
+
+	def batched(self, load):
+		""" load() wrapped to write each batch it's given in pieces of the current batch size """
+		def throttled(batch):
+			start = 0
+			while start < len(batch):
+				piece = batch[start:start + self.size]
+				with self.timed(len(piece)):
+					load(piece)
+				start += len(piece)
+		return throttled